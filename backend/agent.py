@@ -1,9 +1,17 @@
 import os
-import json
-import requests
+import orjson
+import asyncio
+import httpx
 import difflib
 import re
 import time
+import pickle
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+from pathlib import Path
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,6 +21,32 @@ LLM_API_KEY = os.getenv("LLM_API_KEY", "dummy")
 KNOWLEDGE_BASE = {}
 ERROR_PATTERNS = []
 
+def read_knowledge_file(path):
+    """
+    Returns the parsed JSON at `path`, served from a pickled copy when possible.
+    The pickle sits next to the JSON (<filename>.pkl) and is only trusted while
+    it is at least as new as the JSON, so editing the dictionary invalidates it.
+    """
+    cache_path = path + ".pkl"
+    json_mtime = os.stat(path).st_mtime
+
+    if os.path.exists(cache_path) and os.stat(cache_path).st_mtime >= json_mtime:
+        try:
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            print(f"Ignoring stale knowledge cache {cache_path}: {e}")
+
+    data = orjson.loads(Path(path).read_bytes())
+
+    try:
+        with open(cache_path, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        print(f"Could not write knowledge cache {cache_path}: {e}")
+
+    return data
+
 def load_knowledge(filename):
     """
     Loads JSON data.
@@ -22,30 +56,29 @@ def load_knowledge(filename):
     path = os.path.join("data", filename)
     if os.path.exists(path):
         try:
-            with open(path, "r") as f:
-                data = json.load(f)
-                
-                # Check if this is the new Priority Dictionary
-                # It has keys like "priority_1_syntax_and_compile"
-                is_priority_dict = any(k.startswith("priority_") for k in data.keys())
-                
-                if is_priority_dict:
-                    for category_list in data.values():
-                        for err in category_list:
-                            # 1. Add to Regex Detection List
-                            ERROR_PATTERNS.append(err)
-                            
-                            # 2. Add to Knowledge Base (Key = Error Type)
-                            err_type = err['type']
-                            if err_type not in KNOWLEDGE_BASE:
-                                KNOWLEDGE_BASE[err_type] = {}
-                            KNOWLEDGE_BASE[err_type].update(err)
-                else:
-                    # Standard Key-Value Loading (like lab_manual_index.json)
-                    for key, val in data.items():
-                        if key not in KNOWLEDGE_BASE:
-                            KNOWLEDGE_BASE[key] = {}
-                        KNOWLEDGE_BASE[key].update(val)
+            data = read_knowledge_file(path)
+
+            # Check if this is the new Priority Dictionary
+            # It has keys like "priority_1_syntax_and_compile"
+            is_priority_dict = any(k.startswith("priority_") for k in data.keys())
+
+            if is_priority_dict:
+                for category_list in data.values():
+                    for err in category_list:
+                        # 1. Add to Regex Detection List
+                        ERROR_PATTERNS.append(err)
+
+                        # 2. Add to Knowledge Base (Key = Error Type)
+                        err_type = err['type']
+                        if err_type not in KNOWLEDGE_BASE:
+                            KNOWLEDGE_BASE[err_type] = {}
+                        KNOWLEDGE_BASE[err_type].update(err)
+            else:
+                # Standard Key-Value Loading (like lab_manual_index.json)
+                for key, val in data.items():
+                    if key not in KNOWLEDGE_BASE:
+                        KNOWLEDGE_BASE[key] = {}
+                    KNOWLEDGE_BASE[key].update(val)
 
             print(f"Loaded knowledge from {filename}")
         except Exception as e:
@@ -55,6 +88,34 @@ def load_knowledge(filename):
 load_knowledge("error_dictionary.json")
 load_knowledge("lab_manual_index.json")
 
+REGEX_METACHARS = set("\\.^$*+?{}[]()")
+
+def extract_literals(pattern):
+    """
+    Returns the lowercased branches of a plain `foo|bar baz` pattern, or None
+    when any branch uses real regex syntax (then no cheap prefilter is possible).
+    At least one branch must appear in the log for the pattern to match.
+    """
+    if REGEX_METACHARS.intersection(pattern):
+        return None
+    branches = pattern.lower().split("|")
+    if not all(branches):
+        return None
+    return tuple(branches)
+
+def compile_error_patterns(patterns):
+    """
+    Ranks the error entries by priority (stable, so file order breaks ties) and
+    precompiles each one alongside its literal prefilter.
+    """
+    ranked = sorted(patterns, key=lambda x: x['priority'])
+    return [
+        (err, re.compile(err['pattern'], re.IGNORECASE), extract_literals(err['pattern']))
+        for err in ranked
+    ]
+
+RANKED_PATTERNS = compile_error_patterns(ERROR_PATTERNS)
+
 # --- NEW FUNCTION: PRIORITY ANALYZER ---
 def analyze_error_logs(logs):
     """
@@ -63,152 +124,512 @@ def analyze_error_logs(logs):
     """
     if not logs:
         return "SUCCESS", "No errors found."
-        
-    log_text = "\n".join(logs)
-    detected_errors = []
-
-    for err in ERROR_PATTERNS:
-        # Check if the regex pattern exists in the logs
-        if re.search(err['pattern'], log_text, re.IGNORECASE):
-            detected_errors.append(err)
 
-    if not detected_errors:
-        return "SUCCESS", "No errors found."
+    log_text = "\n".join(logs)
+    lowered = log_text.lower()
 
-    # Sort by priority (1 is most critical, 3 is least)
+    # Entries are walked in priority order, so the first hit is the answer.
     # This ensures a 'scanf' warning (P1) overrides a 'Logic Error' (P3)
-    best_match = min(detected_errors, key=lambda x: x['priority'])
-    
-    return best_match['type'], best_match['hint']
+    for err, regex, literals in RANKED_PATTERNS:
+        # Substring search is far cheaper than the regex engine on a miss
+        if literals is not None and not any(lit in lowered for lit in literals):
+            continue
+        if regex.search(log_text):
+            return err['type'], err['hint']
+
+    return "SUCCESS", "No errors found."
 
 # HELPER: MINIMAL SOURCE PATCH GENERATOR
 def create_source_diff(user_code, fixed_code):
-    user_lines = user_code.strip().splitlines()
-    fixed_lines = fixed_code.strip().splitlines()
+    user_code = user_code.strip()
+    fixed_code = fixed_code.strip()
+    if user_code == fixed_code:
+        return None
 
     diff = difflib.unified_diff(
-        user_lines,
-        fixed_lines,
+        user_code.splitlines(),
+        fixed_code.splitlines(),
         n=1,
         lineterm=''
     )
-
-    diff_list = list(diff)
-    if len(diff_list) > 2:
-        return "\n".join(diff_list[2:])
-    return None
+    # Skip the ---/+++ file headers
+    body = "\n".join(islice(diff, 2, None))
+    return body or None
 
 # LLM CALLER
-def call_llm(prompt, expect_json=False):
+# Static framing sent as Gemini's system instruction instead of being
+# repeated at the top of every prompt.
+SYSTEM_INSTRUCTION = (
+    "You are LabTA, a teaching assistant for introductory programming labs. "
+    "Each request gives a student's code, the error it produced, and a concept from the course. "
+    "Follow the [INSTRUCTION] and [OUTPUT FORMAT] sections exactly and teach rather than solve."
+)
+# One pooled async client for every hint: connections to the Gemini endpoint
+# are kept alive (HTTP/2 multiplexed) and waiting on the model never ties up
+# a worker thread. Closed by close_llm_client() on app shutdown.
+ASYNC_CLIENT = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(15.0, connect=3.0),
+    limits=httpx.Limits(max_connections=64),
+)
+# httpx's read timeout applies per streamed chunk; this bounds a whole call,
+# rate-limit retries included, against an upstream that trickles data.
+LLM_DEADLINE_SEC = 45
+
+# CIRCUIT BREAKER
+# More than BREAKER_THRESHOLD failed calls within BREAKER_WINDOW_SEC opens the
+# breaker: for BREAKER_COOLDOWN_SEC no request is sent and hints fall back to
+# the static text from error_dictionary.json instead of piling up on timeouts.
+BREAKER_THRESHOLD = 10
+BREAKER_WINDOW_SEC = 60
+BREAKER_COOLDOWN_SEC = 30
+LLM_FAILURES = deque(maxlen=20)
+BREAKER_OPEN_UNTIL = 0.0
+
+def llm_circuit_open():
+    return time.monotonic() < BREAKER_OPEN_UNTIL
+
+def record_llm_failure():
+    global BREAKER_OPEN_UNTIL
+    now = time.monotonic()
+    LLM_FAILURES.append(now)
+
+    recent = sum(1 for t in LLM_FAILURES if now - t <= BREAKER_WINDOW_SEC)
+    if recent > BREAKER_THRESHOLD:
+        print(f"!!LLM circuit open: {recent} failures in {BREAKER_WINDOW_SEC}s")
+        BREAKER_OPEN_UNTIL = now + BREAKER_COOLDOWN_SEC
+        LLM_FAILURES.clear()
+
+async def close_llm_client():
+    """Stops the batcher, fails every hint still waiting on it, then closes the client."""
+    # The worker goes first so it cannot dispatch another batch meanwhile
+    if BATCH_TASK is not None:
+        BATCH_TASK.cancel()
+        await asyncio.gather(BATCH_TASK, return_exceptions=True)
+    batches = list(PENDING_BATCHES)
+    for task in batches:
+        task.cancel()
+    await asyncio.gather(*batches, return_exceptions=True)
+
+    # Prompts queued but never picked up by the worker
+    while BATCH_QUEUE is not None and not BATCH_QUEUE.empty():
+        fail_batch([BATCH_QUEUE.get_nowait()], RuntimeError("LLM client shut down"))
+    await ASYNC_CLIENT.aclose()
+
+async def fetch_llm_text(prompt, on_text=None):
+    """
+    Streams one prompt through Gemini and returns (raw_text, None) on success,
+    or (None, fallback_message) when no usable answer came back.
+    `on_text`, if given, is called with the text accumulated so far as each
+    streamed chunk arrives, so callers can surface a hint before it is complete.
+    """
     if not LLM_API_KEY or LLM_API_KEY == "dummy": 
-        return "Set API Key in .env for AI.", None
+        return None, "Set API Key in .env for AI."
+
+    if llm_circuit_open():
+        return None, "AI Temporarily Unavailable."
+
+    try:
+        raw_text, failure = await asyncio.wait_for(stream_llm_text(prompt, on_text), LLM_DEADLINE_SEC)
+    except asyncio.TimeoutError:
+        raw_text, failure = None, "AI Error: timed out"
+    if failure:
+        record_llm_failure()
+    return raw_text, failure
 
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={LLM_API_KEY}"
+async def stream_llm_text(prompt, on_text):
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:streamGenerateContent?alt=sse&key={LLM_API_KEY}"
     headers = {"Content-Type": "application/json"}
-    payload = {"contents": [{"parts": [{"text": prompt}]}]}
+    payload = {
+        "systemInstruction": {"parts": [{"text": SYSTEM_INSTRUCTION}]},
+        "contents": [{"parts": [{"text": prompt}]}]
+    }
 
     max_retries = 3
     for attempt in range(max_retries):
         try:
-            res = requests.post(url, json=payload, headers=headers)
+            async with ASYNC_CLIENT.stream("POST", url, json=payload, headers=headers) as res:
+                if res.status_code != 429:
+                    if res.status_code != 200:
+                        return None, f"AI Error: {res.status_code}"
+
+                    chunks = []
+                    async for line in res.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        event = orjson.loads(line[5:])
+                        for part in event['candidates'][0].get('content', {}).get('parts', []):
+                            chunks.append(part.get('text', ''))
+                        if on_text and chunks:
+                            on_text("".join(chunks))
+
+                    if not chunks:
+                        return None, "AI Error: empty response"
+                    return "".join(chunks), None
+
+            # Rate limited: release the connection before backing off
+            await asyncio.sleep(2)
 
-            if res.status_code == 429:
-                time.sleep(2)
-                continue
-
-            if res.status_code != 200:
-                return f"AI Error: {res.status_code}", None
-
-            raw_text = res.json()['candidates'][0]['content']['parts'][0]['text']
+        except Exception as e:
+            print(f"!!EXCEPTION!!: {e}") 
+            return None, "AI Connection Error."
+
+    return None, "AI Quota Exceeded."
+
+# Stand-in when a JSON reply carries no "hint"; shown, but never cached
+DEFAULT_HINT = "Check your logic."
+
+async def call_llm(prompt, expect_json=False, on_text=None):
+    # Partial JSON is useless to a student, so only plain-text hints stream out
+    raw_text, failure = await fetch_llm_text(prompt, on_text=None if expect_json else on_text)
+    if failure:
+        return failure, None
+
+    if expect_json:
+        match = re.search(r'\{.*\}', raw_text, re.DOTALL)
+        if match:
+            clean_text = match.group(0)
+            try:
+                data = orjson.loads(clean_text)
+                return data.get("hint", DEFAULT_HINT), data.get("fixed_code")
+            except orjson.JSONDecodeError:
+                return raw_text, None
+
+    return raw_text, None
+
+# HINT BATCHER
+# Hint prompts that arrive within BATCH_WINDOW_SEC of each other are folded
+# into a single Gemini call (up to BATCH_MAX_SIZE), so a burst of submissions
+# costs one round trip and one unit of the per-minute request quota.
+BATCH_MAX_SIZE = 8
+BATCH_WINDOW_SEC = 0.05
+
+BATCH_QUEUE = None
+BATCH_TASK = None
+PENDING_BATCHES = set()
+
+async def call_llm_batched(prompt, expect_json=False, on_text=None):
+    """
+    Same contract as call_llm, but routed through the micro-batcher.
+    `on_text` only fires when the prompt ends up being sent on its own.
+    """
+    global BATCH_QUEUE, BATCH_TASK
+
+    if BATCH_TASK is None or BATCH_TASK.done():
+        BATCH_QUEUE = asyncio.Queue()
+        BATCH_TASK = asyncio.create_task(batch_worker(BATCH_QUEUE))
+
+    future = asyncio.get_running_loop().create_future()
+    await BATCH_QUEUE.put((prompt, expect_json, on_text, future))
+    return await future
+
+def fail_batch(batch, error):
+    for _, _, _, future in batch:
+        if not future.done():
+            future.set_exception(error)
+
+async def batch_worker(queue):
+    """Collects queued prompts into batches and hands each one off for dispatch."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_SEC
+
+        while len(batch) < BATCH_MAX_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            # Not asyncio.wait_for: it can swallow a cancel that lands as get()
+            # completes, and the worker would outlive close_llm_client()
+            getter = asyncio.ensure_future(queue.get())
+            try:
+                await asyncio.wait({getter}, timeout=remaining)
+            except asyncio.CancelledError:
+                if getter.done():
+                    batch.append(getter.result())
+                else:
+                    getter.cancel()
+                # Shutdown while a window was open: nobody will send these
+                fail_batch(batch, RuntimeError("LLM client shut down"))
+                raise
+            if not getter.done():
+                getter.cancel()
+                break
+            batch.append(getter.result())
+
+        # Dispatch in the background so the next window starts collecting immediately
+        task = asyncio.create_task(dispatch_batch(batch))
+        PENDING_BATCHES.add(task)
+        task.add_done_callback(PENDING_BATCHES.discard)
+
+async def dispatch_batch(batch):
+    try:
+        if len(batch) == 1:
+            prompt, expect_json, on_text, _ = batch[0]
+            results = [await call_llm(prompt, expect_json=expect_json, on_text=on_text)]
+        else:
+            results = await call_llm_combined(batch)
+
+        for (_, _, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+    except asyncio.CancelledError:
+        fail_batch(batch, RuntimeError("LLM client shut down"))
+        raise
+    except Exception as e:
+        fail_batch(batch, e)
+
+async def call_llm_combined(batch):
+    """
+    Asks for every prompt in `batch` in one call and splits the JSON array reply.
+    Any request the model skipped (or an unparseable reply) falls back to its own call.
+    """
+    sections = []
+    for request_id, (prompt, _, _, _) in enumerate(batch):
+        sections.append(f"=== REQUEST {request_id} ===\n{prompt.strip()}")
+
+    combined_prompt = (
+        f"You are answering {len(batch)} independent LabTA requests at once.\n"
+        "Handle each request on its own, following its [INSTRUCTION] and [OUTPUT FORMAT].\n"
+        "Reply with ONLY a JSON array containing one object per request:\n"
+        '{"id": <request number>, "hint": "<the hint text>", "fixed_code": "<fixed code, or null if the request did not ask for it>"}\n\n'
+        + "\n\n".join(sections)
+    )
 
-            if expect_json:
-                match = re.search(r'\{.*\}', raw_text, re.DOTALL)
-                if match:
-                    clean_text = match.group(0)
-                    try:
-                        data = json.loads(clean_text)
-                        return data.get("hint", "Check your logic."), data.get("fixed_code")
-                    except json.JSONDecodeError:
-                        return raw_text, None
+    raw_text, failure = await fetch_llm_text(combined_prompt)
+    if failure:
+        return [(failure, None)] * len(batch)
 
-            return raw_text, None
+    answers = {}
+    match = re.search(r'\[.*\]', raw_text, re.DOTALL)
+    if match:
+        try:
+            for item in orjson.loads(match.group(0)):
+                if isinstance(item, dict) and "id" in item:
+                    answers[str(item["id"])] = item
+        except orjson.JSONDecodeError:
+            answers = {}
+
+    async def resolve(request_id, prompt, expect_json):
+        item = answers.get(str(request_id))
+        if item is None:
+            return await call_llm(prompt, expect_json=expect_json)
+        fixed_code = item.get("fixed_code") if expect_json else None
+        return item.get("hint", DEFAULT_HINT), fixed_code
+
+    return await asyncio.gather(*(
+        resolve(request_id, prompt, expect_json)
+        for request_id, (prompt, expect_json, _, _) in enumerate(batch)
+    ))
+
+# HINT STRATEGIES
+# (strategy, output format, expects JSON) per attempt: vague -> specific -> direct fix
+STRATEGIES = (
+    (
+        "Attempt #1. BE VAGUE. Hint at the concept only. "
+        "Do NOT reveal the solution or line numbers.",
+        "Return the hint as plain text (Max 1 sentence).",
+        False,
+    ),
+    (
+        "Attempt #2. BE SPECIFIC. Point out the exact line or variable causing the issue. "
+        "Explain WHY it is wrong, but do not write the fix yet.",
+        "Return the hint as plain text (Max 2 sentences).",
+        False,
+    ),
+    (
+        "Attempt #3. BE DIRECT. The student is stuck. "
+        "1. Briefly state the fix. "
+        "2. Provide the 'fixed_code' with that change applied.",
+        "Return a JSON object with keys:\n"
+        "- 'hint': A concise explanation.\n"
+        "- 'fixed_code': The student's code with the minimal fix applied.",
+        True,
+    ),
+)
+
+# The static [INSTRUCTION]/[OUTPUT FORMAT] tail of the prompt, rendered once per attempt bucket
+PROMPT_TAILS = tuple(
+    (f"\n\n[INSTRUCTION]\n{strategy}\n\n[OUTPUT FORMAT]\n{output_instruction}\n", expect_json)
+    for strategy, output_instruction, expect_json in STRATEGIES
+)
+
+# Lines of code kept on either side of the error line for attempts 1-2
+CODE_WINDOW_LINES = 20
+
+def code_window(code, error_line):
+    """
+    Trims `code` to CODE_WINDOW_LINES around `error_line` (1-based), marking what
+    was cut. Falls back to the whole file when the line is unknown ("?").
+    """
+    try:
+        line = int(error_line)
+    except (TypeError, ValueError):
+        return code
+
+    lines = code.splitlines()
+    start = max(0, line - 1 - CODE_WINDOW_LINES)
+    end = min(len(lines), line + CODE_WINDOW_LINES)
+    if start == 0 and end == len(lines):
+        return code
+
+    window = lines[start:end]
+    if start > 0:
+        window.insert(0, f"... (lines 1-{start} omitted)")
+    if end < len(lines):
+        window.append(f"... (lines {end + 1}-{len(lines)} omitted)")
+    return "\n".join(window)
+
+def attempt_bucket(attempt):
+    """Maps an attempt count onto its strategy: 1, 2, or 3 for everything after."""
+    return 1 if attempt <= 1 else min(attempt, 3)
+
+# HINT CACHE
+# Finished hints (text + rendered patch) keyed on everything that shapes the
+# prompt. Hot entries live in an in-process LRU, everything is persisted to
+# SQLite so repeated classroom mistakes survive restarts and skip the LLM.
+HINT_CACHE_FILE = os.path.join("data", "hint_cache.sqlite")
+HINT_CACHE_SIZE = 4096
+HINT_MEMORY = OrderedDict()
+HINT_DB = None
+
+# SQLite work runs on worker threads (asyncio.to_thread), which share one
+# connection; HINT_DB_LOCK serializes them.
+HINT_DB_LOCK = threading.Lock()
+
+# Fallback messages produced by the LLM caller; these are never cached
+LLM_FAILURE_PREFIXES = ("Set API Key", "AI Error:", "AI Connection Error", "AI Quota Exceeded", "AI Temporarily Unavailable")
+
+def get_hint_db():
+    global HINT_DB
+    if HINT_DB is None:
+        HINT_DB = sqlite3.connect(HINT_CACHE_FILE, check_same_thread=False)
+        HINT_DB.execute(
+            "CREATE TABLE IF NOT EXISTS hint_cache (key TEXT PRIMARY KEY, hint TEXT, patch TEXT)"
+        )
+    return HINT_DB
+
+# Salted into every cache key, so hints cached under an older prompt or knowledge
+# base are not served after a change. The knowledge files and prompt constants
+# are hashed automatically; bump HINT_PROMPT_VERSION when the prompt assembled in
+# generate_hint / call_llm_combined or the model changes.
+HINT_PROMPT_VERSION = 1
+HINT_CACHE_VERSION = hashlib.sha256(orjson.dumps(
+    [HINT_PROMPT_VERSION, SYSTEM_INSTRUCTION, PROMPT_TAILS, KNOWLEDGE_BASE],
+    default=str, option=orjson.OPT_SORT_KEYS
+)).hexdigest()
+
+def hint_cache_key(language, error_type, attempt, evidence, code):
+    # Attempts past 3 all get the same prompt, so they share a cache slot
+    raw = orjson.dumps(
+        [HINT_CACHE_VERSION, language, error_type, attempt_bucket(attempt), evidence, code], default=str
+    )
+    return hashlib.sha256(raw).hexdigest()
 
-        except Exception as e:
-            print(f"!!EXCEPTION!!: {e}") 
-            return "AI Connection Error.", None
+def is_cacheable_hint(hint_text, fixed_code, expect_json):
+    """Only answers the model actually gave are cached: no fallbacks, no placeholder, no unparsed fix."""
+    if not hint_text or hint_text == DEFAULT_HINT or hint_text.startswith(LLM_FAILURE_PREFIXES):
+        return False
+    # A fix attempt whose reply did not parse into a fixed_code must be retried next time
+    return bool(fixed_code) if expect_json else True
 
-    return "AI Quota Exceeded.", None
+def read_cached_hint(key):
+    with HINT_DB_LOCK:
+        try:
+            return get_hint_db().execute(
+                "SELECT hint, patch FROM hint_cache WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Hint cache read failed: {e}")
+            return None
+
+def write_cached_hint(key, hint, patch):
+    with HINT_DB_LOCK:
+        try:
+            db = get_hint_db()
+            db.execute(
+                "INSERT OR REPLACE INTO hint_cache (key, hint, patch) VALUES (?, ?, ?)",
+                (key, hint, patch)
+            )
+            db.commit()
+        except sqlite3.Error as e:
+            print(f"Hint cache write failed: {e}")
+
+async def lookup_cached_hint(key):
+    if key in HINT_MEMORY:
+        HINT_MEMORY.move_to_end(key)
+        return HINT_MEMORY[key]
+
+    row = await asyncio.to_thread(read_cached_hint, key)
+    if row:
+        remember_hint(key, row)
+    return row
+
+def remember_hint(key, entry):
+    HINT_MEMORY[key] = entry
+    HINT_MEMORY.move_to_end(key)
+    if len(HINT_MEMORY) > HINT_CACHE_SIZE:
+        HINT_MEMORY.popitem(last=False)
+
+async def store_cached_hint(key, hint, patch):
+    remember_hint(key, (hint, patch))
+    await asyncio.to_thread(write_cached_hint, key, hint, patch)
 
 # GENERATE HINT
-def generate_hint(code, language, error_type, attempt, evidence):
+async def generate_hint(code, language, error_type, attempt, evidence, error_line=None, on_text=None):
     # Retrieve merged knowledge
     knowledge = KNOWLEDGE_BASE.get(error_type, {})
 
     # Data for the Frontend
     citation = knowledge.get("citation", "General Concept")
 
+    cache_key = hint_cache_key(language, error_type, attempt, evidence, code)
+    cached = await lookup_cached_hint(cache_key)
+    if cached:
+        hint_text, patch_diff = cached
+        return {
+            "hint": hint_text,
+            "citation": citation,
+            "patch": patch_diff
+        }
+
+    # Upstream is failing: answer from the error dictionary instead of waiting on it
+    if llm_circuit_open():
+        return {
+            "hint": knowledge.get("hint", "Carefully read the error message above and check the line it points to."),
+            "citation": citation,
+            "patch": None
+        }
+
     # Data for the AI
     concept = knowledge.get("concept", "Unknown Error")
     template = knowledge.get("hint_template", "Explain the error clearly.")
 
-    evidence_str = f"Error Context: {evidence}"
-    expect_json = False
-
-    if attempt <= 1:
-        strategy = (
-            "Attempt #1. BE VAGUE. Hint at the concept only. "
-            "Do NOT reveal the solution or line numbers."
-        )
-        output_instruction = "Return the hint as plain text (Max 1 sentence)."
-
-    elif attempt == 2:
-        strategy = (
-            "Attempt #2. BE SPECIFIC. Point out the exact line or variable causing the issue. "
-            "Explain WHY it is wrong, but do not write the fix yet."
-        )
-        output_instruction = "Return the hint as plain text (Max 2 sentences)."
+    bucket = attempt_bucket(attempt)
+    prompt_tail, expect_json = PROMPT_TAILS[bucket - 1]
 
-    else:
-        strategy = (
-            "Attempt #3. BE DIRECT. The student is stuck. "
-            "1. Briefly state the fix. "
-            "2. Provide the 'fixed_code' with that change applied."
-        )
-        output_instruction = (
-            "Return a JSON object with keys:\n"
-            "- 'hint': A concise explanation.\n"
-            "- 'fixed_code': The student's code with the minimal fix applied."
-        )
-        expect_json = True
+    # Hints only need the code near the error; the fix (attempt 3) needs the whole file
+    prompt_code = code if bucket == 3 else code_window(code, error_line)
 
     # PROMPT
-    prompt = f"""
-    You are LabTA.
+    prompt = "".join((
+        "[CONTEXT]\nLanguage: ", language,
+        "\nCode:\n", prompt_code,
+        "\n\n[ERROR DATA]\nError Context: ", str(evidence),
+        "\n\n[KNOWLEDGE BASE]\nConcept: ", concept,
+        "\nRecommended Hint Style: \"", template, "\"",
+        prompt_tail,
+    ))
 
-    [CONTEXT]
-    Language: {language}
-    Code:
-    {code}
-
-    [ERROR DATA]
-    {evidence_str}
-
-    [KNOWLEDGE BASE]
-    Concept: {concept}
-    Recommended Hint Style: "{template}"
-
-    [INSTRUCTION]
-    {strategy}
-
-    [OUTPUT FORMAT]
-    {output_instruction}
-    """
-
-    hint_text, fixed_code_str = call_llm(prompt, expect_json=expect_json)
+    hint_text, fixed_code_str = await call_llm_batched(prompt, expect_json=expect_json, on_text=on_text)
 
     patch_diff = None
     if fixed_code_str:
-        patch_diff = create_source_diff(code, fixed_code_str)
+        # A whole-file rewrite can take a while to diff; keep it off the event loop
+        patch_diff = await asyncio.to_thread(create_source_diff, code, fixed_code_str)
+
+    if is_cacheable_hint(hint_text, fixed_code_str, expect_json):
+        await store_cached_hint(cache_key, hint_text, patch_diff)
 
     return {
         "hint": hint_text,
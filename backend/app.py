@@ -1,50 +1,184 @@
-import json
 import os
-from fastapi import FastAPI, HTTPException, Body
+import uuid
+import asyncio
+import sqlite3
+import threading
+import orjson
+from collections import OrderedDict
+from pathlib import Path
+from fastapi import FastAPI, HTTPException, Body, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, ConfigDict
 from typing import Dict, Any, List, Optional
 from contextlib import asynccontextmanager
 
 # --- INTERNAL MODULE IMPORTS ---
 from backend.sandbox import run_investigation
 # IMPORT THE NEW ANALYZER FUNCTION
-from backend.agent import generate_hint, analyze_error_logs
+from backend.agent import generate_hint, analyze_error_logs, close_llm_client
 from backend.diagnostics import get_first_error
 
 # PERSISTENCE CONFIGURATION
-SESSIONS_FILE = os.path.join("data", "sessions.json")
+SESSIONS_DB = os.path.join("data", "sessions.db")
+LEGACY_SESSIONS_FILE = os.path.join("data", "sessions.json")
 PROBLEMS_FILE = os.path.join("data", "problems.json")
 
-def save_sessions_to_disk(sessions_dict):
-    """Helper to write the current session state to JSON."""
+# Sessions live in SQLite (WAL), one row per (user, problem). Requests never
+# touch the database: they record the row in PENDING_SESSIONS (the latest
+# state per key wins) and session_flusher() writes everything pending in a
+# single transaction every SESSION_FLUSH_SEC, off the event loop.
+# SESSIONS stays the in-memory copy that all reads are served from.
+SESSION_FLUSH_SEC = 1.0
+DB_LOCK = threading.Lock()
+PENDING_LOCK = threading.Lock()
+PENDING_SESSIONS: Dict[str, tuple] = {}
+SESSIONS_CONN = None
+
+def open_sessions_db():
+    conn = sqlite3.connect(SESSIONS_DB, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS sessions (
+            session_key TEXT PRIMARY KEY,
+            user_id TEXT,
+            problem_id TEXT,
+            draft_code TEXT,
+            last_error TEXT,
+            attempt INTEGER NOT NULL DEFAULT 0
+        )"""
+    )
+    return conn
+
+def row_to_state(draft_code, last_error, attempt):
+    user_state = {"last_error": last_error, "attempt": attempt}
+    if draft_code is not None:
+        user_state["draft_code"] = draft_code
+    return user_state
+
+def persist_session(user_id, problem_id, user_state):
+    """Queues one session row for the next flush; the caller updates SESSIONS itself."""
+    session_key = f"{user_id}_{problem_id}"
+    row = (
+        session_key, user_id, problem_id,
+        user_state.get("draft_code"), user_state.get("last_error"), user_state.get("attempt", 0)
+    )
+    with PENDING_LOCK:
+        PENDING_SESSIONS[session_key] = row
+
+def flush_sessions():
+    """Writes every pending session row in one transaction."""
+    global PENDING_SESSIONS
+    # The batch is taken under DB_LOCK, so once rows leave the queue the
+    # connection cannot be closed until they are written
+    with DB_LOCK:
+        with PENDING_LOCK:
+            batch, PENDING_SESSIONS = PENDING_SESSIONS, {}
+        if not batch:
+            return
+
+        try:
+            SESSIONS_CONN.executemany(
+                "INSERT OR REPLACE INTO sessions "
+                "(session_key, user_id, problem_id, draft_code, last_error, attempt) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                batch.values()
+            )
+            SESSIONS_CONN.commit()
+        except sqlite3.Error as e:
+            print(f"!!!!!!Error saving {len(batch)} sessions: {e}")
+            # Put them back unless a newer state was queued in the meantime
+            with PENDING_LOCK:
+                for session_key, row in batch.items():
+                    PENDING_SESSIONS.setdefault(session_key, row)
+
+async def session_flusher():
+    while True:
+        await asyncio.sleep(SESSION_FLUSH_SEC)
+        await asyncio.to_thread(flush_sessions)
+
+def build_problems_payload(problems_data):
+    """Public view of the problem set (no hidden test cases), serialized once."""
+    sanitized = {}
+    for pid, data in problems_data.items():
+        sanitized[pid] = {
+            "title": data.get("title"),
+            "description": data.get("description"),
+            "sample_cases": data.get("sample_cases"),
+            "difficulty": data.get("difficulty", "Unknown"),
+            "case_count": len(data.get("hidden_cases", []))
+        }
+    return orjson.dumps(sanitized)
+
+def import_legacy_sessions():
+    """One-time migration of the old whole-file sessions.json into the database."""
     try:
-        with open(SESSIONS_FILE, "w") as f:
-            json.dump(sessions_dict, f, indent=4)
-    except Exception as e:
-        print(f"!!!!!!Error saving sessions: {e}")
+        legacy = orjson.loads(Path(LEGACY_SESSIONS_FILE).read_bytes())
+    except orjson.JSONDecodeError:
+        print("!!sessions.json was empty or corrupt, nothing to import.")
+        return
+
+    imported = 0
+    for session_key, user_state in legacy.items():
+        # Keys are "<user_id>_<problem_id>" and both halves may contain "_",
+        # so recover the split from the known problem ids.
+        problem_id = next((pid for pid in PROBLEMS_DATA if session_key.endswith(f"_{pid}")), None)
+        if problem_id is None:
+            continue
+        user_id = session_key[:-len(problem_id) - 1]
+        persist_session(user_id, problem_id, user_state)
+        imported += 1
+
+    print(f"Imported {imported} sessions from sessions.json.")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global SESSIONS, PROBLEMS_DATA
+    global SESSIONS, PROBLEMS_DATA, PROBLEMS_PAYLOAD, SESSIONS_CONN
 
     if os.path.exists(PROBLEMS_FILE):
-        with open(PROBLEMS_FILE, "r") as f:
-            PROBLEMS_DATA.update(json.load(f))
+        PROBLEMS_DATA.update(orjson.loads(Path(PROBLEMS_FILE).read_bytes()))
         print(f"Loaded {len(PROBLEMS_DATA)} problems.")
 
-    if os.path.exists(SESSIONS_FILE):
-        try:
-            with open(SESSIONS_FILE, "r") as f:
-                SESSIONS.update(json.load(f))
-            print(f"Loaded {len(SESSIONS)} existing sessions.")
-        except json.JSONDecodeError:
-            print("!!sessions.json was empty or corrupt, starting fresh.")
+    # PROBLEMS_DATA never changes after startup, so /problems is a static payload
+    PROBLEMS_PAYLOAD = build_problems_payload(PROBLEMS_DATA)
+
+    SESSIONS_CONN = open_sessions_db()
+
+    is_empty = SESSIONS_CONN.execute("SELECT 1 FROM sessions LIMIT 1").fetchone() is None
+    if is_empty and os.path.exists(LEGACY_SESSIONS_FILE):
+        import_legacy_sessions()
+        flush_sessions()
+
+    rows = SESSIONS_CONN.execute(
+        "SELECT session_key, draft_code, last_error, attempt FROM sessions"
+    ).fetchall()
+    for session_key, draft_code, last_error, attempt in rows:
+        SESSIONS[session_key] = row_to_state(draft_code, last_error, attempt)
+    print(f"Loaded {len(SESSIONS)} existing sessions.")
+
+    flusher_task = asyncio.create_task(session_flusher())
 
     yield
 
-    print("Saving sessions before shutdown...")
-    save_sessions_to_disk(SESSIONS)
+    # Cancelling does not stop a flush already running in its thread; DB_LOCK
+    # makes the final flush and the close wait for it
+    flusher_task.cancel()
+    try:
+        await flusher_task
+    except asyncio.CancelledError:
+        pass
+    print("Flushing sessions before shutdown...")
+    flush_sessions()
+    with DB_LOCK:
+        SESSIONS_CONN.close()
+
+    # Hints still being generated would only fail once the client is closed
+    for task in list(HINT_TASKS):
+        task.cancel()
+    await asyncio.gather(*HINT_TASKS, return_exceptions=True)
+    await close_llm_client()
 
 # 2. APPLICATION SETUP
 app = FastAPI(
@@ -63,9 +197,53 @@ app.add_middleware(
 
 SESSIONS: Dict[str, Dict] = {}
 PROBLEMS_DATA: Dict[str, Any] = {}
+PROBLEMS_PAYLOAD: bytes = b"{}"
+
+# BACKGROUND HINTS
+# /submit returns the sandbox verdict right away; the LLM hint is produced by
+# a background task and fetched from GET /hint/{hint_id}. Only the most recent
+# MAX_HINT_JOBS results are kept.
+# Jobs live in this process's memory, so the app must run as a single Uvicorn
+# worker; with several, a poll served by another worker gets a 404.
+MAX_HINT_JOBS = 1024
+HINT_JOBS: "OrderedDict[str, Dict]" = OrderedDict()
+HINT_TASKS = set()
+
+def start_hint_job(**hint_kwargs):
+    hint_id = uuid.uuid4().hex
+    job = {"status": "PENDING", "partial_hint": None}
+    HINT_JOBS[hint_id] = job
+    if len(HINT_JOBS) > MAX_HINT_JOBS:
+        HINT_JOBS.popitem(last=False)
+
+    task = asyncio.create_task(run_hint_job(job, hint_kwargs))
+    HINT_TASKS.add(task)
+    task.add_done_callback(HINT_TASKS.discard)
+    return hint_id
+
+async def run_hint_job(job, hint_kwargs):
+    def on_text(text):
+        job["partial_hint"] = text
+
+    try:
+        agent_res = await generate_hint(on_text=on_text, **hint_kwargs)
+    except Exception as e:
+        print(f"!!EXCEPTION!! hint generation failed: {e}")
+        agent_res = {"hint": "AI Connection Error.", "citation": "", "patch": None}
+
+    job.update(
+        status="READY",
+        hint=agent_res.get("hint"),
+        citation=agent_res.get("citation"),
+        patch=agent_res.get("patch")
+    )
 
 # 3. API DATA MODELS
+# Pydantic v2 (Rust core). Code is taken verbatim: no whitespace stripping,
+# and unknown fields are dropped instead of validated.
 class SubmitRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=False)
+
     user_id: str
     problem_id: str
     language: str
@@ -73,6 +251,8 @@ class SubmitRequest(BaseModel):
 
 # Saving Requests
 class SaveRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=False)
+
     user_id: str
     problem_id: str
     code: str
@@ -85,16 +265,7 @@ def health_check():
 
 @app.get("/problems")
 def get_problems():
-    sanitized = {}
-    for pid, data in PROBLEMS_DATA.items():
-        sanitized[pid] = {
-            "title": data.get("title"),
-            "description": data.get("description"),
-            "sample_cases": data.get("sample_cases"),
-            "difficulty": data.get("difficulty", "Unknown"),
-            "case_count": len(data.get("hidden_cases", []))
-        }
-    return sanitized
+    return Response(content=PROBLEMS_PAYLOAD, media_type="application/json")
 
 @app.get("/sessions")
 def get_all_sessions():
@@ -127,12 +298,12 @@ def save_draft(request: SaveRequest):
     user_state["draft_code"] = request.code
 
     SESSIONS[session_key] = user_state
-    save_sessions_to_disk(SESSIONS)
+    persist_session(request.user_id, request.problem_id, user_state)
 
     return {"status": "SAVED", "message": "Code saved successfully."}
 
 @app.post("/submit")
-def submit_code(request: SubmitRequest):
+async def submit_code(request: SubmitRequest):
 
     user_id = request.user_id
     problem_id = request.problem_id
@@ -140,8 +311,9 @@ def submit_code(request: SubmitRequest):
     if problem_id not in PROBLEMS_DATA:
         raise HTTPException(status_code=404, detail="Problem ID not found")
 
-    # 1. Run the Sandbox
-    logs, raw_status, evidence = run_investigation(
+    # 1. Run the Sandbox (blocking Docker calls stay off the event loop)
+    logs, raw_status, evidence = await run_in_threadpool(
+        run_investigation,
         code=request.code,
         language=request.language,
         problem_id=problem_id,
@@ -164,9 +336,11 @@ def submit_code(request: SubmitRequest):
         clean_evidence = evidence
 
     # Standard cleaning for raw sandbox errors
+    error_line = None
     if final_status in ["SYNTAX_ERROR", "RUNTIME_ERROR"] and isinstance(evidence, str):
         diag = get_first_error(evidence, request.language)
         clean_evidence = f"Line {diag['line']}: {diag['msg']}"
+        error_line = diag['line']
 
     # 3. Session Management
     session_key = f"{user_id}_{problem_id}"
@@ -186,26 +360,23 @@ def submit_code(request: SubmitRequest):
     user_state["last_error"] = final_status
 
     SESSIONS[session_key] = user_state
-    save_sessions_to_disk(SESSIONS)
+    persist_session(user_id, problem_id, user_state)
 
-    # 4. Generate AI Hint & Patch
+    # 4. Queue the AI Hint & Patch (fetched via GET /hint/{hint_id})
     hint = "Congratulations! You are ready for the next challenge."
-    citation = ""
-    patch = None
+    hint_id = None
 
     if final_status != "SUCCESS":
-        agent_res = generate_hint(
+        hint = None
+        hint_id = start_hint_job(
             code=request.code,
             language=request.language,
             error_type=final_status,
             attempt=user_state["attempt"],
-            evidence=clean_evidence
+            evidence=clean_evidence,
+            error_line=error_line
         )
 
-        hint = agent_res.get("hint")
-        citation = agent_res.get("citation")
-        patch = agent_res.get("patch")
-
         # Logic Errors unlock diffs after 3 attempts
         if final_status == "LOGIC_ERROR" and user_state["attempt"] >= 3:
             logs.append("\n**Diff Analysis Unlocked (Attempt 3+):**")
@@ -217,8 +388,29 @@ def submit_code(request: SubmitRequest):
         "agent_logs": logs,
         "system_messages": system_messages,
         "hint": hint,
-        "citation": citation,
-        "patch": patch
+        "hint_id": hint_id,
+        "citation": "",
+        "patch": None
+    }
+
+@app.get("/hint/{hint_id}")
+def get_hint(hint_id: str):
+    """
+    Polled by the IDE after /submit. 202 while the hint is still being
+    generated (with any text streamed so far), 200 once it is final.
+    """
+    job = HINT_JOBS.get(hint_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Hint not found")
+
+    if job["status"] == "PENDING":
+        return JSONResponse(status_code=202, content={"status": "PENDING", "partial_hint": job["partial_hint"]})
+
+    return {
+        "status": "READY",
+        "hint": job["hint"],
+        "citation": job["citation"],
+        "patch": job["patch"]
     }
 
 if __name__ == "__main__":
@@ -1,55 +1,89 @@
+import io
+import os
 import re
 
-PATTERNS = {
-    # GCC/G++ Output: "temp.c:10:5: error: expected ';'"
-    # Capture Groups: 1=File, 2=Line, 3=Col, 4=Type, 5=Message
-    "c": r"(.*?):(\d+):(\d+): (error|warning|fatal error): (.+)",
-    "cpp": r"(.*?):(\d+):(\d+): (error|warning|fatal error): (.+)",
-    # Java Compiler Output (javac)
-    "java": r"(.*?):(\d+): error: (.+)",
-    # Python Special Case
-    "python": "SPECIAL_HANDLING"
+# Compiled once at import and run with one MULTILINE search over the whole
+# stderr buffer, so the scan for the first diagnostic stays inside the C engine.
+# Each pattern matches a whole line: leading blanks are skipped and the message
+# ends at its last non-space character. Only errors are matched; warnings that
+# gcc prints before the real error are skipped.
+
+# GCC/G++ Output: "temp.c:10:5: error: expected ';'"
+# Capture Groups: 1=File, 2=Line, 3=Col, 4=Type, 5=Message
+GCC_RE = re.compile(r"^[^\S\n]*(.*?):(\d+):(\d+): (error|fatal error): (.*\S)", re.MULTILINE)
+# Java Compiler Output (javac): "Main.java:7: error: ';' expected"
+# Capture Groups: 1=File, 2=Line, 3=Message
+JAVAC_RE = re.compile(r"^[^\S\n]*(.*?):(\d+): error: (.*\S)", re.MULTILINE)
+
+# language -> (pattern, line group, col group or None, message group)
+# Python is handled by parse_python_error and has no entry.
+LANG_CFG = {
+    "c": (GCC_RE, 2, 3, 5),
+    "cpp": (GCC_RE, 2, 3, 5),
+    "java": (JAVAC_RE, 2, None, 3),
+}
+
+# Python traceback frame: File "/app/main.py", line 3
+PY_FILE_LINE_RE = re.compile(r'File "(.*?)", line (\d+)')
+# Java stack frame: at Main.main(Main.java:7)
+JAVA_TRACE_RE = re.compile(r'at .*?\((.*?):(\d+)\)')
+NON_SPACE_RE = re.compile(r'\S')
+
+# Sandbox file name -> name shown to the student, keyed by the last path component
+BASENAME_MAP = {
+    "temp.c": "main.c",
+    "temp.cpp": "main.cpp",
+    "temp.py": "main.py",
+    "Main.java": "Main.java",
 }
 
 def clean_file_path(path: str) -> str:
-    if "temp.c" in path: return "main.c"
-    if "temp.cpp" in path: return "main.cpp"
-    if "temp.py" in path: return "main.py"
-    if "Main.java" in path: return "Main.java"
-    return "code"
+    return BASENAME_MAP.get(os.path.basename(path), "code")
+
+def first_line(text: str, start: int = 0, limit: int = None) -> str:
+    """Returns the line starting at `start` (at most `limit` chars) without splitting the rest of `text`."""
+    stop = len(text) if limit is None else start + limit
+    end = text.find('\n', start, stop)
+    return text[start:stop if end == -1 else end]
+
+def iter_lines_reversed(text: str):
+    """Yields the lines of `text` bottom-up (like reversed(text.split('\\n'))) without building a list."""
+    end = len(text)
+    while True:
+        start = text.rfind('\n', 0, end)
+        yield text[start + 1:end]
+        if start == -1:
+            return
+        end = start
 
 def parse_python_error(stderr_output: str):
-    lines = stderr_output.split('\n')
-    error_msg = "Runtime Error"
-    line_num = "?"
-    # 1. Get the Error Message
-    for line in reversed(lines):
-        if line.strip() and "Error:" in line:
+    error_msg = None
+    line_num = None
+    # Single pass from the bottom: the last "...Error:" line is the message and
+    # the last 'File "...", line N' frame is the deepest one, where it failed.
+    for line in iter_lines_reversed(stderr_output):
+        if error_msg is None and "Error:" in line:
             error_msg = line.strip()
+        if line_num is None:
+            match = PY_FILE_LINE_RE.search(line)
+            if match:
+                line_num = match.group(2)
+        if error_msg is not None and line_num is not None:
             break
-    # 2. Get the Line Number
-    line_pattern = re.compile(r'File "(.*?)", line (\d+)')
-    for line in lines:
-        match = line_pattern.search(line)
-        if match:
-            line_num = match.group(2)
     return {
-        "line": line_num,
+        "line": line_num or "?",
         "col": "0",
-        "msg": error_msg,
+        "msg": error_msg or "Runtime Error",
         "raw": stderr_output
     }
 
 def parse_java_traceback(stderr_output: str):
     """Parses Java Runtime Stack Traces for line numbers."""
-    lines = stderr_output.split('\n')
-    error_msg = lines[0] if lines else "Runtime Error"
+    error_msg = first_line(stderr_output)
     line_num = "?"
 
-    trace_pattern = re.compile(r'at .*?\((.*?):(\d+)\)')
-
-    for line in lines:
-        match = trace_pattern.search(line)
+    for line in io.StringIO(stderr_output):
+        match = JAVA_TRACE_RE.search(line)
         if match:
             if "Main.java" in match.group(1):
                 line_num = match.group(2)
@@ -70,27 +104,20 @@ def get_first_error(stderr_output: str, language: str):
         return parse_python_error(stderr_output)
 
     # STANDARD COMPILERS (C, C++, JAVA COMPILE)
-    pattern = PATTERNS.get(language)
-    if pattern:
-        regex = re.compile(pattern)
-        for line in stderr_output.split('\n'):
-            match = regex.match(line.strip())
-            if match:
-                # FIRST ERROR LOGIC: Return immediately on first match
-                if language == "java":
-                    return {
-                        "line": match.group(2),
-                        "col": "0",
-                        "msg": match.group(3).strip(),
-                        "raw": line.strip()
-                    }
-                else: # C/C++
-                    return {
-                        "line": match.group(2),
-                        "col": match.group(3),
-                        "msg": match.group(5).strip(),
-                        "raw": line.strip()
-                    }
+    # Every pattern needs a literal "error:", and a substring test is far cheaper
+    # than running the regex over warning-only or runtime output
+    cfg = LANG_CFG.get(language)
+    if cfg and "error:" in stderr_output:
+        regex, line_group, col_group, msg_group = cfg
+        # FIRST ERROR LOGIC: the leftmost match is the first matching line
+        match = regex.search(stderr_output)
+        if match:
+            return {
+                "line": match.group(line_group),
+                "col": match.group(col_group) if col_group else "0",
+                "msg": match.group(msg_group).strip(),
+                "raw": match.group(0).strip()
+            }
 
     # JAVA RUNTIME FALLBACK
     if language == "java":
@@ -98,9 +125,10 @@ def get_first_error(stderr_output: str, language: str):
         if trace_result["line"] != "?":
             return trace_result
 
-    # FALLBACK
+    # FALLBACK: first non-blank line, read straight out of the buffer
+    first = NON_SPACE_RE.search(stderr_output)
     return {
         "line": "?",
-        "msg": stderr_output.strip().split('\n')[0][:150],
+        "msg": first_line(stderr_output, first.start(), 150).rstrip() if first else "",
         "raw": stderr_output
     }
\ No newline at end of file
@@ -12,6 +12,7 @@ const urlParams = new URLSearchParams(window.location.search);
 const PROBLEM_ID = urlParams.get("id");
 let editor;
 let pendingPatchCode = null; // Store patch data while waiting for confirmation
+let activeHintId = null; // Only the latest submission's hint gets rendered
 
 document.addEventListener("DOMContentLoaded", async () => {
   // 1. Initialize CodeMirror
@@ -345,6 +346,7 @@ async function handleRun() {
   const runBtn = document.getElementById("run-btn");
 
   runBtn.disabled = true;
+  activeHintId = null;
   consoleDiv.innerHTML = `<div class="log-entry">> Initializing Docker...</div>`;
   hintDiv.innerHTML = `<div style="text-align:center; padding:20px; color:#888;">AI is analyzing...</div>`;
 
@@ -370,10 +372,45 @@ async function handleRun() {
       )
       .join("");
 
-    renderAIResponse(data, hintDiv);
+    if (data.hint_id) {
+      pollHint(data, hintDiv);
+    } else {
+      renderAIResponse(data, hintDiv);
+    }
   } catch (e) {
     consoleDiv.innerHTML += `<div class="log-entry error">> Connection Error</div>`;
   } finally {
     runBtn.disabled = false;
   }
 }
+
+/* --- BACKEND: HINT POLLING --- */
+// /submit answers with the verdict right away; the AI hint is fetched here.
+async function pollHint(data, hintDiv) {
+  const hintId = data.hint_id;
+  activeHintId = hintId;
+
+  for (let i = 0; i < 120; i++) {
+    if (activeHintId !== hintId) return; // A newer run took over the panel
+
+    try {
+      const res = await fetch(`${API_BASE}/hint/${hintId}`);
+      const hintData = await res.json();
+
+      if (res.status === 200) {
+        renderAIResponse({ ...data, ...hintData, status: data.status }, hintDiv);
+        return;
+      }
+      if (res.status === 202 && hintData.partial_hint) {
+        renderAIResponse({ ...data, hint: hintData.partial_hint }, hintDiv);
+      }
+      if (res.status === 404) break;
+    } catch (e) {}
+
+    await new Promise((resolve) => setTimeout(resolve, 1000));
+  }
+
+  if (activeHintId === hintId) {
+    renderAIResponse({ ...data, hint: "AI hint is unavailable right now." }, hintDiv);
+  }
+}
@@ -0,0 +1,221 @@
+"""LabTA in-container test harness.
+
+Runs one whole submission per `docker exec`. The job arrives as JSON on stdin:
+
+    {"compile": [argv] | null, "run": [argv], "timeout": sec, "workers": n,
+     "memory_limit": bytes | null, "cpu_limit": sec,
+     "cases": [{"input": str, "expected_sha256": str}, ...]}
+
+Each case runs under prlimit with its own address-space and CPU-time caps,
+so one case cannot use up the memory the container gives all parallel cases.
+
+One JSON line is written to stdout per step, in order: the compile step as
+{"case": "compile", ...}, then {"case": i, "exit": code, "stdout": str, "stderr": str}
+for each test case ("stdout" is null when it matched). Expected outputs only
+arrive as hashes, so the hidden answers never sit in plain text inside the
+container. stdout is hashed as it arrives and only its first STDOUT_HEAD bytes
+are kept for the report, so a program printing in a loop cannot grow the
+harness until the container kills it. The harness stops after a failed compile or after the first case
+that exits non-zero or prints the wrong output; the backend still judges every
+line itself.
+"""
+
+import hashlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+TIMEOUT_EXIT = 124
+OOM_EXIT = 137
+# At most 64 KB of stderr is kept, the head (first compiler error) and the tail
+# (Python traceback), so a program flooding stderr cannot grow the harness or
+# the backend without bound.
+STDERR_HEAD = 48 * 1024
+STDERR_TAIL = 16 * 1024
+# stdout is judged by its running hash; only this much is kept for the diff
+STDOUT_HEAD = 64 * 1024
+# Once a case has exited, how long to wait for the last of its output. A
+# descendant that escaped the process group may hold the pipes open forever;
+# whatever arrived by then is the case's output.
+READ_GRACE_SEC = 0.5
+# What a language runtime prints when the address-space limit makes an
+# allocation fail; reported like the kernel OOM kill (137).
+OOM_MARKERS = (b"MemoryError", b"std::bad_alloc", b"java.lang.OutOfMemoryError")
+
+def limited(argv, memory_limit, cpu_limit):
+    """Prefixes argv with prlimit so the case gets its own memory and CPU caps."""
+    limits = [f"--cpu={cpu_limit}:{cpu_limit + 1}"]
+    if memory_limit:
+        limits.append(f"--as={memory_limit}")
+    return ["prlimit", *limits, "--", *argv]
+
+def pump_stdin(proc, data):
+    try:
+        proc.stdin.write(data)
+        proc.stdin.close()
+    except OSError:
+        pass # program exited without reading all of its input
+
+def collect_hashed(stream, sink):
+    head = sink["head"]
+    # `ahead` hashes everything after the leading whitespace; sink["digest"] is
+    # a copy taken at the last non-whitespace byte, i.e. the hash of out.strip()
+    ahead = hashlib.sha256()
+    started = False
+    while True:
+        chunk = stream.read1(65536)
+        if not chunk:
+            break
+        room = STDOUT_HEAD - len(head)
+        if len(chunk) > room:
+            sink["dropped"] = True
+        if room > 0:
+            head += chunk[:room]
+
+        if not started:
+            chunk = chunk.lstrip()
+            if not chunk:
+                continue
+            started = True
+        body = chunk.rstrip()
+        if body:
+            ahead.update(body)
+            sink["digest"] = ahead.copy()
+            chunk = chunk[len(body):]
+        ahead.update(chunk)
+
+def collect_capped(stream, sink):
+    head, tail = sink["head"], sink["tail"]
+    # Keep draining past the cap so the program never blocks on a full pipe,
+    # remembering only the tail (where Python puts its traceback)
+    while True:
+        chunk = stream.read1(65536)
+        if not chunk:
+            break
+        room = STDERR_HEAD - len(head)
+        if room > 0:
+            head += chunk[:room]
+            chunk = chunk[room:]
+        if chunk:
+            tail += chunk
+            if len(tail) > STDERR_TAIL:
+                del tail[:len(tail) - STDERR_TAIL]
+                sink["dropped"] = True
+
+def kill_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def run_step(argv, input_str, timeout, memory_limit=None, cpu_limit=None):
+    if cpu_limit:
+        argv = limited(argv, memory_limit, cpu_limit)
+    # Own session so everything the program spawned can be killed with it
+    proc = subprocess.Popen(
+        argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        start_new_session=True
+    )
+    out = {"head": bytearray(), "dropped": False, "digest": None}
+    err = {"head": bytearray(), "tail": bytearray(), "dropped": False}
+    threading.Thread(target=pump_stdin, args=(proc, input_str.encode()), daemon=True).start()
+    readers = [
+        threading.Thread(target=collect_hashed, args=(proc.stdout, out), daemon=True),
+        threading.Thread(target=collect_capped, args=(proc.stderr, err), daemon=True),
+    ]
+    for thread in readers:
+        thread.start()
+    try:
+        code = proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_group(proc)
+        proc.wait()
+        code = TIMEOUT_EXIT
+    # Leftover background processes must not outlive the case
+    kill_group(proc)
+    grace_end = time.monotonic() + READ_GRACE_SEC
+    for thread in readers:
+        thread.join(max(0, grace_end - time.monotonic()))
+
+    stderr = bytes(err["head"])
+    if err["dropped"]:
+        stderr += b"\n... [stderr truncated] ...\n"
+    stderr += bytes(err["tail"])
+
+    stdout = bytes(out["head"])
+    if out["dropped"]:
+        stdout += b"\n... [stdout truncated] ...\n"
+    digest = out["digest"] or hashlib.sha256()
+
+    # Report signals the way a shell would (SIGSEGV -> 139, SIGKILL/OOM -> 137)
+    if code == -signal.SIGXCPU:
+        code = TIMEOUT_EXIT
+    elif code < 0:
+        code = 128 - code
+    if memory_limit and code not in (0, TIMEOUT_EXIT) and any(marker in stderr for marker in OOM_MARKERS):
+        code = OOM_EXIT
+    # Output stays as bytes until someone needs it as text
+    return {
+        "exit": code, "stdout": stdout, "stderr": stderr,
+        "stdout_sha256": digest.hexdigest(), "stdout_truncated": out["dropped"]
+    }
+
+def emit(result, case, ok=False):
+    # A passing case's stdout equals the expected output, which the backend
+    # already has; it is sent as null instead of being decoded and shipped.
+    record = {
+        "case": case,
+        "exit": result["exit"],
+        "stdout": None if ok else result["stdout"].decode("utf-8", "replace"),
+        "stderr": result["stderr"].decode("utf-8", "replace")
+    }
+    sys.stdout.write(json.dumps(record) + "\n")
+    sys.stdout.flush()
+
+def passed(result, expected_sha256):
+    if result["exit"] != 0:
+        return False
+    if result["stdout_sha256"] == expected_sha256:
+        return True
+    if result["stdout_truncated"]:
+        return False
+    # Slow path, same comparison the backend makes: decoded text, str.strip()
+    text = result["stdout"].decode("utf-8", "replace").strip()
+    return hashlib.sha256(text.encode()).hexdigest() == expected_sha256
+
+def main():
+    job = json.load(sys.stdin)
+    timeout = job["timeout"]
+
+    if job["compile"]:
+        result = run_step(job["compile"], "", timeout)
+        emit(result, "compile")
+        if result["exit"] != 0:
+            return
+
+    cases = job["cases"]
+    if not cases:
+        return
+
+    pool = ThreadPoolExecutor(max_workers=max(1, min(job["workers"], len(cases))))
+    futures = [
+        pool.submit(run_step, job["run"], case["input"], timeout, job["memory_limit"], job["cpu_limit"])
+        for case in cases
+    ]
+    for index, case in enumerate(cases):
+        result = futures[index].result()
+        ok = passed(result, case["expected_sha256"])
+        emit(result, index, ok)
+        if not ok:
+            for pending in futures[index + 1:]:
+                pending.cancel()
+            break
+    pool.shutdown(wait=True)
+
+if __name__ == "__main__":
+    main()